@@ -1,143 +1,549 @@
-import os
+import re
+import asyncio
 import datetime
-import dateparser
-import anthropic
-import gspread
+import hashlib
+import itertools
+import time
+import threading
+import sys
+import weakref
+from dateparser.date import DateDataParser
 import json
-from dotenv import load_dotenv
-from oauth2client.service_account import ServiceAccountCredentials
+import logging
+import logging.handlers
+import queue
 from telegram import Update
+from telegram.constants import ChatAction
 from telegram.ext import (
-    Application, CommandHandler, ContextTypes, ConversationHandler,
-    MessageHandler, filters
+    AIORateLimiter, Application, BaseUpdateProcessor, CommandHandler,
+    ContextTypes, ConversationHandler, MessageHandler, filters
 )
-# Load environment variables
-load_dotenv()
+from services import TELEGRAM_TOKEN, get_cache_db, get_claude, get_sheet
 
-# Configuration constants
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
-GOOGLE_CREDENTIALS_FILE = os.getenv("GOOGLE_CREDENTIALS_FILE")
-GOOGLE_SHEET_NAME = os.getenv("GOOGLE_SHEET_NAME")
+logger = logging.getLogger(__name__)
 
-# Initialize Anthropic client
-client = anthropic.Anthropic(api_key=CLAUDE_API_KEY)
+class SheetsWriter:
+    """
+    Buffer rows and append them to the worksheet in batches.
+
+    Handlers enqueue rows and return immediately; a background task flushes
+    up to `max_rows` rows at once, or whatever is pending after `max_delay`
+    seconds, with a single values.append call. The worksheet is fetched
+    through `get_worksheet` on the first flush, off the event loop.
 
-# Google Sheets setup
-def setup_google_sheets():
+    Rows from a failed flush are queued again for the next batch, up to
+    `max_attempts` writes per row.
     """
-    Set up connection to Google Sheets using service account credentials.
-    
-    Returns:
-        gspread.Worksheet: The first worksheet of the specified Google Sheet
+
+    def __init__(self, get_worksheet, max_rows=100, max_delay=2.0, max_attempts=3):
+        self.get_worksheet = get_worksheet
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    async def enqueue(self, row):
+        await self.queue.put((row, 0))
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Ask the background task to flush everything still pending, including
+        the batch it is collecting, and wait for it to finish.
+        """
+        if self.task:
+            await self.queue.put(None)
+            await self.task
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            items = [item]
+            deadline = loop.time() + self.max_delay
+            while len(items) < self.max_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+            await self.flush(items, retry=not stopping)
+        # Write rows requeued by a failed flush or enqueued after stop()
+        items = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                items.append(item)
+        if items:
+            await self.flush(items, retry=False)
+
+    async def flush(self, items, retry=True):
+        """
+        Write queued (row, attempts) items, requeueing them on failure.
+        """
+        rows = [row for row, _ in items]
+        # gspread is synchronous; run the request in a worker thread so the
+        # event loop keeps serving updates while Sheets responds
+        try:
+            await asyncio.to_thread(self.append_rows, rows)
+        except Exception:
+            logger.exception("Error logging %d rows to Google Sheets", len(rows))
+            for row, attempts in items:
+                if retry and attempts + 1 < self.max_attempts:
+                    self.queue.put_nowait((row, attempts + 1))
+                else:
+                    logger.error("Dropping row after %d attempts: %s", attempts + 1, row)
+
+    def append_rows(self, rows):
+        self.get_worksheet().append_rows(
+            rows,
+            value_input_option='RAW',
+            insert_data_option='INSERT_ROWS'
+        )
+
+sheets_writer = SheetsWriter(get_sheet)
+
+class ExtractionCache:
     """
-    scope = [
-        "https://spreadsheets.google.com/feeds", 
-        "https://www.googleapis.com/auth/drive"
-    ]
-    creds = ServiceAccountCredentials.from_json_keyfile_name(
-        GOOGLE_CREDENTIALS_FILE, 
-        scope
-    )
-    gspread_client = gspread.authorize(creds)
-    return gspread_client.open(GOOGLE_SHEET_NAME).sheet1
+    Persist extraction results keyed by a hash of the context message.
+
+    The key also includes today's date, since relative expressions such as
+    "yesterday" resolve to a different timestamp on a different day; rows
+    from earlier days can never be hit again and are removed by `prune`.
+    The database is opened through `get_db` on first use, and every query
+    runs in a worker thread under one lock, so a commit's fsync never
+    blocks the event loop.
+    """
+
+    def __init__(self, get_db):
+        self.get_db = get_db
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(context_message, day):
+        payload = f"{day}\n{context_message}"
+        return hashlib.blake2b(payload.encode()).hexdigest()
+
+    async def get(self, context_message):
+        day = datetime.date.today().isoformat()
+        return await asyncio.to_thread(self.read, self.key(context_message, day))
+
+    async def set(self, context_message, extracted_data):
+        day = datetime.date.today().isoformat()
+        await asyncio.to_thread(
+            self.write, self.key(context_message, day), day, json.dumps(extracted_data)
+        )
 
-# Initialize Google Sheets
-sheet = setup_google_sheets()
+    async def prune(self):
+        """
+        Delete entries cached on earlier days.
+        """
+        await asyncio.to_thread(self.delete_before, datetime.date.today().isoformat())
+
+    def read(self, key):
+        with self.lock:
+            row = self.get_db().execute(
+                "SELECT data FROM extractions WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write(self, key, day, data):
+        with self.lock:
+            db = self.get_db()
+            db.execute(
+                "INSERT OR REPLACE INTO extractions (key, day, data) VALUES (?, ?, ?)",
+                (key, day, data)
+            )
+            db.commit()
+
+    def delete_before(self, day):
+        with self.lock:
+            db = self.get_db()
+            db.execute("DELETE FROM extractions WHERE day IS NULL OR day < ?", (day,))
+            db.commit()
+
+extraction_cache = ExtractionCache(get_cache_db)
 
 # Define conversation states
 CONTEXT, MISSING_INFO, END = range(3)
 
+# Disambiguates interaction IDs created within the same clock tick
+interaction_counter = itertools.count()
+
+# Patterns for fields that can be pulled out without a model call
+# The domain ends on a label, so trailing sentence punctuation is left out
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+# No "." separator and no start inside another number, so a dotted date
+# such as 11.30.2024 is never merged with a following phone number
+PHONE_RE = re.compile(r"(?<![\w.])\+?\d[\d\s()-]{7,}\d")
+# Only unambiguous date expressions: relative days, numeric dates with a
+# year (a bare 3/4 is as likely a fraction), and a month name next to a day
+# number. A bare "May" or "June" is more often a name than a date, so it is
+# never matched on its own.
+MONTH_PATTERN = (
+    r"(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?"
+    r"|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\.?"
+)
+DATE_RE = re.compile(
+    r"\b(?:today|yesterday"
+    r"|\d{4}-\d{1,2}-\d{1,2}"
+    r"|\d{1,2}/\d{1,2}/\d{2,4}"
+    rf"|{MONTH_PATTERN}\s+\d{{1,2}}(?:st|nd|rd|th)?(?:,?\s+\d{{4}})?"
+    rf"|\d{{1,2}}(?:st|nd|rd|th)?\s+(?:of\s+)?{MONTH_PATTERN}(?:,?\s+\d{{4}})?"
+    r")(?!\w)",
+    re.IGNORECASE
+)
+
+# Built once so locale data is loaded at import rather than per message;
+# relative expressions resolve against the current time by default, and
+# dates without a year resolve to the past since the meeting already happened
+date_parser = DateDataParser(languages=['en'], settings={'PREFER_DATES_FROM': 'past'})
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Start the conversation and ask for context.
     """
-    context.user_data['ID'] = f"{update.effective_chat.id}-{int(datetime.datetime.now().timestamp())}"
+    context.user_data['ID'] = f"{update.effective_chat.id}-{time.time_ns()}-{next(interaction_counter)}"
     await update.message.reply_text("Hi! Please tell me about the person you met.")
     return CONTEXT
 
-async def extract_fields_from_context(context_message):
+def parse_timestamp(text):
     """
-    Use Claude to extract Name, Timestamp, and Context from the context message.
+    Parse a date expression such as "yesterday" or "Nov 30" into YYYY-MM-DD.
+
+    Returns:
+        str: The ISO date, or '' if the text could not be parsed
+    """
+    text = text.strip()
+    # Fast path for replies that are already YYYY-MM-DD
+    try:
+        return datetime.date.fromisoformat(text).isoformat()
+    except ValueError:
+        pass
+    parsed = date_parser.get_date_data(text).date_obj
+    return parsed.date().isoformat() if parsed else ''
+
+def extract_fields_locally(message):
     """
-    prompt = f"""[
-        {{
-            "type": "text",
-            "text": "<examples>\\n<example>\\n<example_description>\\n<analysis>\\n1. Name: The context message mentions \\"Alice Johnson\\".\\n2. Timestamp: The message states \\"yesterday\\" and mentions \\"boston\\". We'll use this location information to determine the correct date.\\n3. Location: The interaction occurred at the \\"startup boston conference\\", so the location is Boston, MA.\\n4. Context: The message provides details about a discussion on potential collaboration and Alice's interest in solar energy.\\n5. Contact Info: An email address is provided: alice.johnson@example.com.\\n\\nAnalyzing the location and timestamp:\\nThe message mentions \\"boston\\", which refers to Boston, MA, USA. Since the interaction happened \\"yesterday\\" in Boston, we need to calculate the date based on the current date in Boston's time zone (Eastern Time). Assuming the current date is December 1, 2024, \\"yesterday\\" would be November 30, 2024.\\n\\nSummarizing the key points for the Context field:\\nThe interaction involved discussing potential collaboration on a new project. Additionally, Alice expressed interest in solar energy and mentioned having an uncle in the industry.\\n\\nMissing or unclear information:\\nThe context message doesn't provide any phone number or additional contact information beyond the email address.\\n</analysis>\\n</example_description>\\n<context_message>\\nI met Alice Johnson yesterday at the startup boston conference. We discussed potential collaboration on a new project and she mentioned something about how he was really interested in solar and had an uncle in the industry. Her email is alice.johnson@example.com.\\n</context_message>\\n<ideal_output>\\n{{\\n  \\"Name\\": \\"Alice Johnson\\",\\n  \\"Timestamp\\": \\"2024-11-30\\",\\n  \\"Location\\": \\"Boston, MA\\",\\n  \\"Context\\": \\"Discussed potential collaboration on a new project. Interested in solar energy and has an uncle in the industry.\\",\\n  \\"Contact Info\\": \\"alice.johnson@example.com\\"\\n}}\\n</ideal_output>\\n</example>\\n</examples>\\n\\n"
-        }},
-        {{
-            "type": "text",
-            "text": {context_message}
-        }}
+    Pull contact info and an unambiguous date out of a message with regexes,
+    parsing the date with dateparser.
+    Keys match the extract_data tool schema so results can be merged with
+    Claude's output.
+    """
+    fields = {}
+    contacts = EMAIL_RE.findall(message)
+    # Require ten digits so dates like 2024-11-30 are not read as phone numbers
+    contacts += [
+        match.strip() for match in PHONE_RE.findall(message)
+        if sum(char.isdigit() for char in match) >= 10
     ]
-"""
+    if contacts:
+        fields['contact_info'] = ', '.join(contacts)
+    for match in DATE_RE.finditer(message):
+        timestamp = parse_timestamp(match.group())
+        if timestamp:
+            fields['timestamp'] = timestamp
+            break
+    return fields
+
+# Static extraction prompt, kept at module level so every request sends an
+# identical prefix
+EXTRACTION_SYSTEM_PROMPT = "You are an AI assistant designed to extract key details from a given context message and populate a virtual rolodex. Your task is to analyze the provided message and return a structured JSON object containing relevant information.\n\nThe context message you need to analyze is given in the user turn inside <context_message> tags.\n\nPlease extract the following information from the context message and organize it into a JSON object:\n\n1. Name: The full name of the person mentioned in the context.\n2. Timestamp: The time or date when the interaction occurred. If an exact date is not provided, infer it based on time expressions like \"yesterday\" or \"last week\". Use any location information provided in the message to determine the correct date.\n3. Location: The place where the interaction occurred or where the person is located.\n4. Context: A brief, shorthand summary of the conversation or relevant details about the interaction, capturing every detail of the context. You don't need to mention meeting them.\n5. Contact Info: Any contact information provided, such as email address or phone number.\n6. Class: Gauge whether this person is of one of the 4 following Classes: Professional, Academic, Personal, or Other. Assume people met in class or on campus are academic unless theres is positive and friendly sentiment regarding the interaction that could signal potential friendship outside of my courses.\n\nBefore providing the final JSON output, wrap your analysis process inside <analysis> tags. This will help ensure a thorough interpretation of the data.\n\nIn your analysis process:\n1. For each field (Name, Timestamp, Location, Context, and Contact Info), quote the relevant information from the context message.\n2. Analyze any location information provided and explain how you'll use it to determine the correct timestamp.\n3. Summarize the key points of the interaction for the Context field.\n4. Note any information that is missing or unclear in the context message.\n\nAfter your analysis, provide the final JSON output with the extracted information.\n\nOutput Format:\nThe JSON object should have the following structure:\n\n{\n  \"Name\": \"\",\n  \"Timestamp\": \"\",\n  \"Location\": \"\",\n  \"Context\": \"\",\n  \"Contact Info\": \"\"\n}\n\nPlease proceed with your analysis and provide the only the JSON output for the given context message."
+
+EXTRACTION_EXAMPLES = "<examples>\n<example>\n<example_description>\n<analysis>\n1. Name: The context message mentions \"Alice Johnson\".\n2. Timestamp: The message states \"yesterday\" and mentions \"boston\". We'll use this location information to determine the correct date.\n3. Location: The interaction occurred at the \"startup boston conference\", so the location is Boston, MA.\n4. Context: The message provides details about a discussion on potential collaboration and Alice's interest in solar energy.\n5. Contact Info: An email address is provided: alice.johnson@example.com.\n\nAnalyzing the location and timestamp:\nThe message mentions \"boston\", which refers to Boston, MA, USA. Since the interaction happened \"yesterday\" in Boston, we need to calculate the date based on the current date in Boston's time zone (Eastern Time). Assuming the current date is December 1, 2024, \"yesterday\" would be November 30, 2024.\n\nSummarizing the key points for the Context field:\nThe interaction involved discussing potential collaboration on a new project. Additionally, Alice expressed interest in solar energy and mentioned having an uncle in the industry.\n\nMissing or unclear information:\nThe context message doesn't provide any phone number or additional contact information beyond the email address.\n</analysis>\n</example_description>\n<context_message>\nI met Alice Johnson yesterday at the startup boston conference. We discussed potential collaboration on a new project and she mentioned something about how he was really interested in solar and had an uncle in the industry. Her email is alice.johnson@example.com.\n</context_message>\n<ideal_output>\n{\n  \"Name\": \"Alice Johnson\",\n  \"Timestamp\": \"2024-11-30\",\n  \"Location\": \"Boston, MA\",\n  \"Context\": \"Discussed potential collaboration on a new project. Interested in solar energy and has an uncle in the industry.\",\n  \"Contact Info\": \"alice.johnson@example.com\"\n}\n</ideal_output>\n</example>\n</examples>\n\n"
+
+# Kept on 3.5 Haiku, the model this prompt was written and tested against;
+# claude-3-haiku is cheaper but hasn't been evaluated on it. The forced tool
+# call guarantees structured output. The per-record cap matches the original
+# single-message limit, since the Context summary is asked to capture every
+# detail; responses that still hit it are discarded rather than used truncated.
+EXTRACTION_MODEL = "claude-3-5-haiku-20241022"
+EXTRACTION_MAX_TOKENS_PER_RECORD = 1000
+
+EXTRACTION_TOOL = {
+    "name": "extract_data",
+    "description": "Record detailed rolodex-styled summary of user messages using well-structured JSON.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "name": {
+                "type": "string",
+                "description": "Name of main person of topic in the user message or 'None' if not provided",
+            },
+            "context": {
+                "type": "string",
+                "description": "Short hand summary of context of the user's message",
+            },
+            "location": {
+                "type": "string",
+                "description": "Location mentioned in user message or 'None' if not provided",
+            },
+            "timestamp": {
+                "type": "string",
+                "description": "Timestamp mentioned in user message based on time expression or 'None' if not provided",
+            },
+            "contact_info": {
+                "type": "string",
+                "description": "Contact information mentioned in user message or 'None' if not provided",
+            },
+        },
+        "required": ["context"],
+    },
+}
+
+EXTRACTION_BATCH_TOOL = {
+    "name": "extract_batch",
+    "description": "Record one rolodex-styled summary per numbered context message, in the order given.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "records": {
+                "type": "array",
+                "items": EXTRACTION_TOOL["input_schema"],
+            },
+        },
+        "required": ["records"],
+    },
+}
 
+# Only the tool the model is forced to call is offered on each request
+EXTRACTION_TOOLS = {
+    "extract_data": [EXTRACTION_TOOL],
+    "extract_batch": [EXTRACTION_BATCH_TOOL],
+}
+
+EXTRACTION_SYSTEM_BLOCKS = [
+    {"type": "text", "text": EXTRACTION_SYSTEM_PROMPT},
+    # Marks tools + system prompt + examples as a cacheable prefix. At about
+    # 1.5-1.8k tokens this is below Haiku's 2048-token caching minimum, so it
+    # has no effect until the prompt grows past that
+    {"type": "text", "text": EXTRACTION_EXAMPLES, "cache_control": {"type": "ephemeral"}},
+]
+
+# Only the user turn varies per request; it is filled in with str.format
+EXTRACTION_MESSAGE_TEMPLATE = "<context_message>\n{context_message}\n</context_message>"
+EXTRACTION_BATCH_PREAMBLE = "Extract the details for each of the following context messages, returning one record per message in the same order.\n\n"
+EXTRACTION_BATCH_ITEM_TEMPLATE = "<context_message index=\"{index}\">\n{context_message}\n</context_message>"
+
+async def call_extraction_tool(tool_name, content, max_tokens):
+    """
+    Make one Claude request forced to call `tool_name`.
+
+    Returns:
+        dict: The tool input, or None if the request failed, was cut off by
+        the token cap, or did not produce an object
+    """
     try:
-        response = client.messages.create(
-            model="claude-3-5-haiku-20241022",
-            max_tokens=1000,
+        response = await get_claude().messages.create(
+            model=EXTRACTION_MODEL,
+            max_tokens=max_tokens,
             temperature=0,
-            tools=[
-                {
-                    "name": "extract_data",
-                    "description": "Record detailed rolodex-styled summary of user messages using well-structured JSON.",
-                    "input_schema": {
-                        "type": "object",
-                        "properties": {
-                            "name": {
-                                "type": "string",
-                                "description": "Name of main person of topic in the user message or 'None' if not provided",
-                            },
-                            "context": {
-                                "type": "string",
-                                "description": "Short hand summary of context of the user's message",
-                            },
-                            "location": {
-                                "type": "string",
-                                "description": "Location mentioned in user message or 'None' if not provided",
-                            },
-                            "timestamp": {
-                                "type": "string",
-                                "description": "Timestamp mentioned in user message based on time expression or 'None' if not provided",
-                            },
-                            "contact_info": {
-                                "type": "string",
-                                "description": "Contact information mentioned in user message or 'None' if not provided",
-                            },
-                        },
-                        "required": ["context"],
-                    },
-                }
-            ],
-            tool_choice={"type": "tool", "name": "extract_data"},
-            system="You are an AI assistant designed to extract key details from a given context message and populate a virtual rolodex. Your task is to analyze the provided message and return a structured JSON object containing relevant information.\n\nHere is the context message you need to analyze:\n\n<context_message>\n{{context_message}}\n</context_message>\n\nPlease extract the following information from the context message and organize it into a JSON object:\n\n1. Name: The full name of the person mentioned in the context.\n2. Timestamp: The time or date when the interaction occurred. If an exact date is not provided, infer it based on time expressions like \"yesterday\" or \"last week\". Use any location information provided in the message to determine the correct date.\n3. Location: The place where the interaction occurred or where the person is located.\n4. Context: A brief, shorthand summary of the conversation or relevant details about the interaction, capturing every detail of the context. You don't need to mention meeting them.\n5. Contact Info: Any contact information provided, such as email address or phone number.\n6. Class: Gauge whether this person is of one of the 4 following Classes: Professional, Academic, Personal, or Other. Assume people met in class or on campus are academic unless theres is positive and friendly sentiment regarding the interaction that could signal potential friendship outside of my courses.\n\nBefore providing the final JSON output, wrap your analysis process inside <analysis> tags. This will help ensure a thorough interpretation of the data.\n\nIn your analysis process:\n1. For each field (Name, Timestamp, Location, Context, and Contact Info), quote the relevant information from the context message.\n2. Analyze any location information provided and explain how you'll use it to determine the correct timestamp.\n3. Summarize the key points of the interaction for the Context field.\n4. Note any information that is missing or unclear in the context message.\n\nAfter your analysis, provide the final JSON output with the extracted information.\n\nOutput Format:\nThe JSON object should have the following structure:\n\n{\n  \"Name\": \"\",\n  \"Timestamp\": \"\",\n  \"Location\": \"\",\n  \"Context\": \"\",\n  \"Contact Info\": \"\"\n}\n\nPlease proceed with your analysis and provide the only the JSON output for the given context message.",
-            messages=[{'role': 'user', 'content': prompt}]
+            tools=EXTRACTION_TOOLS[tool_name],
+            tool_choice={"type": "tool", "name": tool_name},
+            system=EXTRACTION_SYSTEM_BLOCKS,
+            messages=[{'role': 'user', 'content': content}]
         )
-        response_text = response.content
-        #extracted_data = json.loads(response_text)
-        # Extract the JSON-like object
-        if isinstance(response_text, list) and len(response_text) > 0:
-            tool_block = response_text[0]  # Access the first ToolUseBlock
-            if hasattr(tool_block, 'input'):
-                extracted_data = tool_block.input  # Extract the 'input' field
-                return extracted_data
-            else:
-                print("ToolUseBlock does not have an 'input' field.")
-                return {}
-        else:
-            print("Invalid response format.")
-            return {}
-    except Exception as e:
-        print(f"Error parsing Claude response: {e}")
-        return {}
+        # tool_choice forces a single tool call, so it is always the first
+        # block; a malformed response raises and is handled below
+        extracted_data = response.content[0].input
+    except Exception:
+        logger.exception("Error parsing Claude response")
+        return None
+
+    # A tool call cut off by the token cap is incomplete; returning it would
+    # also get it cached for the rest of the day
+    if response.stop_reason == "max_tokens":
+        logger.warning("Claude response for %s hit max_tokens.", tool_name)
+        return None
+    return extracted_data if isinstance(extracted_data, dict) else None
+
+async def request_extraction(context_message):
+    """
+    Extract a single message with the extract_data tool.
+
+    Returns:
+        dict: The extracted fields, or {} if extraction failed
+    """
+    extracted_data = await call_extraction_tool(
+        "extract_data",
+        EXTRACTION_MESSAGE_TEMPLATE.format(context_message=context_message),
+        EXTRACTION_MAX_TOKENS_PER_RECORD
+    )
+    return extracted_data or {}
+
+async def request_extractions(context_messages):
+    """
+    Extract every message in the batch with one Claude request.
+
+    If the batched call fails, or some of its records are unusable, those
+    messages are retried one at a time so a single bad record doesn't cost
+    the whole batch.
+
+    Returns:
+        list: One extracted dict per message, {} where extraction failed
+    """
+    if len(context_messages) == 1:
+        return [await request_extraction(context_messages[0])]
+
+    content = EXTRACTION_BATCH_PREAMBLE + "\n\n".join(
+        EXTRACTION_BATCH_ITEM_TEMPLATE.format(index=index, context_message=message)
+        for index, message in enumerate(context_messages, start=1)
+    )
+    extracted_data = await call_extraction_tool(
+        "extract_batch",
+        content,
+        min(EXTRACTION_MAX_TOKENS_PER_RECORD * len(context_messages), 8192)
+    )
+    records = extracted_data.get("records") if extracted_data else None
+    if not isinstance(records, list) or len(records) != len(context_messages):
+        logger.warning("Batch of %d messages failed; extracting them individually.", len(context_messages))
+        records = [None] * len(context_messages)
+
+    retry = [index for index, record in enumerate(records) if not isinstance(record, dict) or not record]
+    if retry:
+        singles = await asyncio.gather(
+            *(request_extraction(context_messages[index]) for index in retry)
+        )
+        for index, record in zip(retry, singles):
+            records[index] = record
+    return records
+
+class ExtractionBatcher:
+    """
+    Collect context messages from concurrent conversations into one request.
+
+    The first pending message opens a window of `max_delay` seconds; every
+    message submitted within it, up to `max_batch`, goes out in the same
+    Claude call and each caller gets its own record back.
+
+    Records are generated one after another, so each caller also waits for
+    the others in its batch; `max_batch` stays small to bound that wait and
+    the total generation time of a single request.
+    """
+
+    def __init__(self, max_batch=4, max_delay=0.08):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.dispatches = set()
+
+    async def submit(self, context_message):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((context_message, future))
+        return await future
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch without waiting so the next window opens immediately
+            dispatch = asyncio.create_task(self.dispatch(batch))
+            self.dispatches.add(dispatch)
+            dispatch.add_done_callback(self.dispatches.discard)
+
+    async def dispatch(self, batch):
+        results = []
+        try:
+            results = await request_extractions([message for message, _ in batch])
+        except Exception:
+            logger.exception("Error extracting batch of %d messages", len(batch))
+        finally:
+            # Every caller must get an answer, or its handler waits forever
+            for index, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(results[index] if index < len(results) else {})
+
+extraction_batcher = ExtractionBatcher()
+
+async def extract_fields_from_context(context_message):
+    """
+    Use Claude to extract Name, Timestamp, and Context from the context message.
+    Results are cached, so a repeated message skips the API call.
+    """
+    cached = await extraction_cache.get(context_message)
+    if cached is not None:
+        return cached
+
+    extracted_data = await extraction_batcher.submit(context_message)
+    if extracted_data:
+        await extraction_cache.set(context_message, extracted_data)
+    return extracted_data
+
+async def save_interaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Queue the collected interaction for Google Sheets and confirm to the user.
+
+    Queueing never waits; the row write happens in the background and is
+    retried there if Sheets fails.
+    """
+    row = [
+        context.user_data['ID'],
+        context.user_data['Name'],
+        context.user_data['Location'],
+        context.user_data['Context'],
+        context.user_data['Timestamp'],
+        context.user_data['Contact_Info'],
+        context.user_data['Follow-Up Status']
+    ]
+    await sheets_writer.enqueue(row)
+    await update.message.reply_text("Thank you! Your information has been saved.")
+
+async def send_typing(chat):
+    """
+    Show the typing indicator; a failure here must not abort the handler.
+    """
+    try:
+        await chat.send_action(ChatAction.TYPING)
+    except Exception:
+        logger.warning("Could not send typing action", exc_info=True)
 
 async def context_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Save the context provided by the user and attempt to extract fields.
     """
     context_message = update.message.text
+    # Acknowledge right away; the extraction reply is a tool call, not text we
+    # can stream. Runs alongside the extraction instead of ahead of it.
+    context.application.create_task(send_typing(update.message.chat), update=update)
     extracted_data = await extract_fields_from_context(context_message)
-    print(f"Extracted data: {extracted_data}")
+    # Fill in anything Claude missed that the local pass picked up
+    for key, value in extract_fields_locally(context_message).items():
+        if extracted_data.get(key) in (None, '', 'None'):
+            extracted_data[key] = value
+    logger.info("Extracted data: %s", extracted_data)
     # Save whatever data was extracted
     context.user_data['Context'] = extracted_data.get('context', context_message)
     context.user_data['Name'] = extracted_data.get('name', '')
@@ -163,20 +569,7 @@ async def context_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return MISSING_INFO
     else:
         # All fields are present, save to Google Sheets
-        try:
-            sheet.append_row([
-                context.user_data['ID'],
-                context.user_data['Name'],
-                context.user_data['Location'],
-                context.user_data['Context'],
-                context.user_data['Timestamp'],
-                context.user_data['Contact_Info'],
-                context.user_data['Follow-Up Status']
-            ])
-            await update.message.reply_text("Thank you! Your information has been saved.")
-        except Exception as e:
-            print(f"Error logging to Google Sheets: {e}")
-            await update.message.reply_text("There was an error saving your information.")
+        await save_interaction(update, context)
         return ConversationHandler.END
 
 async def missing_info_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -191,7 +584,17 @@ async def missing_info_state(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     # Attempt to extract missing fields from user's reply
     # Update context.user_data with any found information
+    local_fields = extract_fields_locally(user_reply)
+    if 'Contact_Info' in missing_fields and local_fields.get('contact_info'):
+        context.user_data['Contact_Info'] = local_fields['contact_info']
+    if 'Timestamp' in missing_fields:
+        # Read the whole reply as a date only when it answers the field we
+        # asked for; otherwise "Her name is June" would become June 15
+        whole_reply = parse_timestamp(user_reply) if missing_fields[0] == 'Timestamp' else ''
+        context.user_data['Timestamp'] = whole_reply or local_fields.get('timestamp', '')
     for field in missing_fields:
+        if context.user_data.get(field):
+            continue
         if field in user_reply:
             context.user_data[field] = user_reply  # Add more sophisticated extraction as needed
     
@@ -205,20 +608,7 @@ async def missing_info_state(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return MISSING_INFO
     
     # All information collected, save to Google Sheets
-    try:
-        sheet.append_row([
-            context.user_data['ID'],
-            context.user_data['Name'],
-            context.user_data['Location'],
-            context.user_data['Context'],
-            context.user_data['Timestamp'],
-            context.user_data['Contact_Info'],
-            context.user_data['Follow-Up Status']
-        ])
-        await update.message.reply_text("Thank you! Your information has been saved.")
-    except Exception as e:
-        print(f"Error logging to Google Sheets: {e}")
-        await update.message.reply_text("There was an error saving your information.")
+    await save_interaction(update, context)
     
     return ConversationHandler.END
 
@@ -229,11 +619,117 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Conversation cancelled.")
     return ConversationHandler.END
 
+class PerConversationUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates from different conversations concurrently, but one at a
+    time within a conversation.
+
+    ConversationHandler is not safe under fully concurrent updates: a second
+    message arriving while context_state waits on Claude would still be
+    routed by the old state and race on the same user_data. Conversations
+    are keyed by (chat_id, user_id), matching ConversationHandler's default.
+
+    PTB takes its concurrency slot before calling do_process_update, so an
+    update queued behind its conversation would hold a slot other chats
+    need. PTB's limit is therefore left effectively unbounded, and
+    `max_concurrent_updates` is enforced here, only around the update that
+    is actually running.
+    """
+
+    def __init__(self, max_concurrent_updates=256):
+        super().__init__(sys.maxsize)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        # Entries disappear once no update for that conversation holds the lock
+        self.locks = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def conversation_key(update):
+        if not isinstance(update, Update):
+            return None
+        chat, user = update.effective_chat, update.effective_user
+        if chat is None and user is None:
+            return None
+        return (chat.id if chat else None, user.id if user else None)
+
+    async def do_process_update(self, update, coroutine):
+        key = self.conversation_key(update)
+        if key is None:
+            async with self.slots:
+                await coroutine
+            return
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        async with lock:
+            async with self.slots:
+                await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+async def post_init(application: Application):
+    """
+    Start background workers once the application's event loop is running.
+    """
+    # Connect to Sheets up front so bad credentials fail at startup, and open
+    # the cache database off the event loop, dropping entries from past days
+    await asyncio.to_thread(get_sheet)
+    await asyncio.to_thread(get_cache_db)
+    await extraction_cache.prune()
+    sheets_writer.start()
+    extraction_batcher.start()
+
+async def post_shutdown(application: Application):
+    """
+    Stop background workers and flush pending rows before the process exits.
+    """
+    await extraction_batcher.stop()
+    await sheets_writer.stop()
+    await get_claude().close()
+
+def setup_logging():
+    """
+    Route log records through a queue so handlers only enqueue them; a
+    listener thread does the formatting and stream I/O.
+
+    Returns:
+        logging.handlers.QueueListener: The started listener
+    """
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    # httpx logs every polling request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
 def main():
     """
     Set up and run the Telegram bot application.
     """
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    log_listener = setup_logging()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        # Handle different conversations in parallel so one user's Claude call
+        # doesn't hold up everyone else, while keeping each one's updates in order
+        .concurrent_updates(PerConversationUpdateProcessor())
+        # Shape outgoing messages to Telegram's flood limits instead of
+        # hitting RetryAfter and backing off
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     conv_handler = ConversationHandler(
         entry_points=[MessageHandler(filters.TEXT & ~filters.COMMAND, start)],
@@ -245,8 +741,11 @@ def main():
     )
 
     application.add_handler(conv_handler)
-    print("Bot is running. Press Ctrl+C to stop.")
-    application.run_polling()
+    logger.info("Bot is running. Press Ctrl+C to stop.")
+    try:
+        application.run_polling()
+    finally:
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
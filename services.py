@@ -0,0 +1,85 @@
+import os
+import functools
+import sqlite3
+import anthropic
+import gspread
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Configuration constants
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
+GOOGLE_CREDENTIALS_FILE = os.getenv("GOOGLE_CREDENTIALS_FILE")
+GOOGLE_SHEET_ID = os.getenv("GOOGLE_SHEET_ID")
+GOOGLE_SHEET_NAME = os.getenv("GOOGLE_SHEET_NAME")
+EXTRACTION_CACHE_FILE = os.getenv("EXTRACTION_CACHE_FILE", "extraction_cache.sqlite3")
+
+# Each getter builds its dependency on first use and returns the same
+# instance afterwards, so nothing connects or authenticates at import time
+
+@functools.lru_cache(maxsize=1)
+def get_http_client():
+    """
+    Create the shared HTTP client for API calls.
+
+    One pooled, keep-alive HTTP/2 connection means TLS and TCP setup happen
+    once rather than per request. The SDK's own client class is used so it
+    matches whichever HTTP library the installed SDK is built on, and it
+    keeps the SDK's default timeout and connection limits; a full extraction
+    batch can take well past 30 seconds to generate.
+
+    Returns:
+        anthropic.DefaultAsyncHttpxClient: The shared client
+    """
+    return anthropic.DefaultAsyncHttpxClient(http2=True)
+
+@functools.lru_cache(maxsize=1)
+def get_claude():
+    """
+    Create the Anthropic client on top of the shared HTTP client.
+
+    Returns:
+        anthropic.AsyncAnthropic: The Claude client
+    """
+    return anthropic.AsyncAnthropic(api_key=CLAUDE_API_KEY, http_client=get_http_client())
+
+@functools.lru_cache(maxsize=1)
+def get_sheet():
+    """
+    Set up connection to Google Sheets using service account credentials.
+
+    Opens the sheet by GOOGLE_SHEET_ID when set, which skips the Drive name
+    lookup; GOOGLE_SHEET_NAME is kept as a fallback.
+
+    Returns:
+        gspread.Worksheet: The first worksheet of the specified Google Sheet
+    """
+    # google-auth keeps the access token in memory and refreshes it only
+    # once it expires
+    gspread_client = gspread.service_account(filename=GOOGLE_CREDENTIALS_FILE)
+    if GOOGLE_SHEET_ID:
+        return gspread_client.open_by_key(GOOGLE_SHEET_ID).sheet1
+    return gspread_client.open(GOOGLE_SHEET_NAME).sheet1
+
+@functools.lru_cache(maxsize=1)
+def get_cache_db():
+    """
+    Open the sqlite database backing the extraction cache.
+
+    The connection is only used from worker threads, one at a time.
+
+    Returns:
+        sqlite3.Connection: The cache database connection
+    """
+    db = sqlite3.connect(EXTRACTION_CACHE_FILE, check_same_thread=False)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS extractions (key TEXT PRIMARY KEY, day TEXT, data TEXT NOT NULL)"
+    )
+    # Caches created before the day column existed; their rows are pruned
+    columns = [row[1] for row in db.execute("PRAGMA table_info(extractions)")]
+    if "day" not in columns:
+        db.execute("ALTER TABLE extractions ADD COLUMN day TEXT")
+    db.commit()
+    return db